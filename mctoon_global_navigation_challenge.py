@@ -1,19 +1,68 @@
+import argparse
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import os
+import queue
+import socketserver
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time as time_module
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import Any, Optional, Tuple
 
 import numpy as np
-import torch
-import torch.nn as nn
 from skyfield.api import Angle, N, S, Star, W, load
 from skyfield.data import hipparcos
 from skyfield.named_stars import named_star_dict
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Celestial navigation fixes")
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="reduce sight sets read as JSON lines from stdin",
+    )
+    parser.add_argument(
+        "--socket",
+        metavar="PATH",
+        help="reduce sight sets read as JSON lines from a Unix socket",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="PATH",
+        help="keep fixes in PATH and reuse them for identical sight sets",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=CelestialFix.BACKENDS,
+        default="numpy",
+        help="the local fix backend (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.INFO)
 
-    cf = CelestialFix()
+    cache = None
+    if args.cache_dir is not None:
+        cache = FixCache(args.cache_dir)
+
+    if args.serve or args.socket is not None:
+        server = FixServer(backend=args.backend, cache=cache)
+        if args.socket is not None:
+            server.serve_unix(args.socket)
+        else:
+            server.serve_stream(sys.stdin, sys.stdout)
+        return
+
+    cf = CelestialFix(backend=args.backend, cache=cache)
     cf.add_observation("Arcturus", cf.ut1(2022, 3, 28, 0, 22, 33, tz=-5), dms(45.7))
     cf.add_observation("Polaris", cf.ut1(2022, 3, 28, 0, 21, 45, tz=-5), dms(45.6))
     cf.add_observation("Procyon", cf.ut1(2022, 3, 28, 0, 19, 51, tz=-5), dms(25.2))
@@ -91,6 +140,43 @@ class ObservationParams:
 
         return -minutes / 60.0
 
+    def body_correction(self, alt_observed, semidiameter, horizontal_parallax, limb):
+        """Correct the altitude of a limb of the Sun or the Moon to its center.
+
+        Also corrects any body for parallax in altitude.
+        """
+        if not self.needs_correction:
+            return alt_observed
+
+        alt_deg = alt_observed.degrees + horizontal_parallax.degrees * np.cos(
+            alt_observed.radians
+        )
+
+        if limb == "lower":
+            alt_deg += semidiameter.degrees
+        elif limb == "upper":
+            alt_deg -= semidiameter.degrees
+        elif limb is not None:
+            raise ValueError(f"Invalid limb: {limb}")
+
+        return Angle(degrees=alt_deg)
+
+
+# The solar system bodies by their names in the ephemeris, and their radii in km.
+BODIES = {
+    "Sun": ("sun", 696000.0),
+    "Moon": ("moon", 1737.4),
+    "Venus": ("venus", 6051.8),
+    "Mars": ("mars", 3389.5),
+    "Jupiter": ("jupiter barycenter", 69911.0),
+    "Saturn": ("saturn barycenter", 58232.0),
+}
+EARTH_RADIUS_KM = 6378.14
+
+# The bodies whose limbs are observed. The planets are brought down to the horizon by
+# their centers; their semidiameters are well below the precision of a sextant.
+LIMB_BODIES = ("Sun", "Moon")
+
 
 def coord_to_vector(pos):
     lat, lon = pos[0], pos[1]
@@ -147,12 +233,91 @@ def plane_intersection(ps, ns):
     return np.linalg.lstsq(m, b, rcond=None)[0]
 
 
+def icosphere(subdivisions):
+    """The vertices and edges of a subdivided icosahedron on the unit sphere.
+
+    Returns the vertices as a 3xN matrix and the edges as a 2xE matrix of vertex
+    indices. Each subdivision splits every triangle into four.
+    """
+    phi = (1.0 + np.sqrt(5.0)) / 2.0
+    vertices = [
+        (-1.0, phi, 0.0),
+        (1.0, phi, 0.0),
+        (-1.0, -phi, 0.0),
+        (1.0, -phi, 0.0),
+        (0.0, -1.0, phi),
+        (0.0, 1.0, phi),
+        (0.0, -1.0, -phi),
+        (0.0, 1.0, -phi),
+        (phi, 0.0, -1.0),
+        (phi, 0.0, 1.0),
+        (-phi, 0.0, -1.0),
+        (-phi, 0.0, 1.0),
+    ]
+    faces = [
+        (0, 11, 5),
+        (0, 5, 1),
+        (0, 1, 7),
+        (0, 7, 10),
+        (0, 10, 11),
+        (1, 5, 9),
+        (5, 11, 4),
+        (11, 10, 2),
+        (10, 7, 6),
+        (7, 1, 8),
+        (3, 9, 4),
+        (3, 4, 2),
+        (3, 2, 6),
+        (3, 6, 8),
+        (3, 8, 9),
+        (4, 9, 5),
+        (2, 4, 11),
+        (6, 2, 10),
+        (8, 6, 7),
+        (9, 8, 1),
+    ]
+
+    for _ in range(subdivisions):
+        midpoints = {}
+
+        def midpoint(a, b):
+            key = (min(a, b), max(a, b))
+            if key not in midpoints:
+                midpoints[key] = len(vertices)
+                vertices.append(
+                    tuple((np.array(vertices[a]) + np.array(vertices[b])) / 2.0)
+                )
+            return midpoints[key]
+
+        new_faces = []
+        for a, b, c in faces:
+            ab, bc, ca = midpoint(a, b), midpoint(b, c), midpoint(c, a)
+            new_faces += [(a, ab, ca), (b, bc, ab), (c, ca, bc), (ab, bc, ca)]
+        faces = new_faces
+
+    vecs = np.array(vertices).T
+    vecs /= np.linalg.norm(vecs, axis=0)
+
+    faces = np.array(faces)
+    edges = np.concatenate((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]))
+    edges = np.unique(np.sort(edges, axis=1), axis=0).T
+
+    return (vecs, edges)
+
+
 @dataclass
 class Observation:
     star: str
-    gp: Tuple[Angle, Angle]
     alt: Angle
+    # Computed from star and time on demand, see CelestialFix.resolve_gps().
+    gp: Optional[Tuple[Angle, Angle]] = None
+    time: Any = None
     mag: Optional[Angle] = None
+    # Solar system bodies are corrected once their distance is known. The altitude
+    # before that correction is kept for CelestialFix.cache_key().
+    limb: Optional[str] = None
+    observation_params: Optional[ObservationParams] = None
+    alt_uncorrected: Optional[Angle] = None
 
 
 @dataclass
@@ -165,70 +330,201 @@ class RhumbLineMovement:
         return self.speed_knots * self.duration_hours
 
 
-class NavigationModel(nn.Module):
-    """A local optimization model which takes observer movement into account."""
+class FixCache:
+    """A content-addressed cache of fixes, keyed by CelestialFix.cache_key().
 
-    R_NM = 360.0 * 60.0 / (2.0 * torch.pi)
+    Fixes are kept in an in-memory LRU of up to max_entries. If directory is given,
+    they are also stored there as one small JSON file per key, and the least recently
+    used files are evicted once the directory grows past max_bytes.
 
-    def __init__(self, starting_pos, log):
-        super().__init__()
+    max_bytes limits the sum of the file sizes, not the space they take on disk. Each
+    file is about 55 bytes but occupies at least a filesystem block, typically 4 KiB,
+    so the directory takes up to about 75 times max_bytes. With several processes
+    sharing the directory, each one only notices the files of the others when it
+    scans it, so the limit may be exceeded until then.
+    """
 
-        self.log = log
-        self.starting_lat = nn.Parameter(torch.tensor(starting_pos[0].radians))
-        self.starting_lon = nn.Parameter(torch.tensor(starting_pos[1].radians))
-        # Assume a small common error in all observations.
-        self.observation_error = nn.Parameter(torch.tensor(0.0))
+    # Evict down to this fraction of max_bytes, so that the directory is only scanned
+    # once in a while rather than on every put.
+    EVICT_TO = 0.75
 
-    def forward(self):
-        positions = []
-        dist_errors = []
-        loss = torch.tensor(0.0)
+    def __init__(self, directory=None, *, max_entries=128, max_bytes=16 * 1024 * 1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
 
-        lat, lon = self.starting_lat, self.starting_lon
-        positions.append((Angle(radians=lat.item()), Angle(radians=lon.item())))
+        # The size of the directory as of the last scan plus the files put since, None
+        # until it has been scanned.
+        self.disk_bytes = None
 
-        for item in self.log:
-            if isinstance(item, Observation):
-                gp_lat = torch.tensor(item.gp[0].radians)
-                gp_lon = torch.tensor(item.gp[1].radians)
-                alt_deg = torch.tensor(item.alt.degrees) + self.observation_error
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
 
-                dist_nm = self.distance_to_circle_nm(
-                    pos=(lat, lon), gp=(gp_lat, gp_lon), alt_deg=alt_deg
-                )
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
 
-                loss += torch.square(dist_nm)
+        if self.directory is None:
+            return None
 
-                # Could use the magnetic heading as well; not sure if it's helpful. It
-                # could be harmful given bad measurements. What weight factor to use?
+        path = self.path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
 
-                if False:
-                    if item.mag is not None:
-                        mag = self.angle_to_gp(pos=(lat, lon), gp=(gp_lat, gp_lon))
-                        loss += torch.square(
-                            torch.remainder(
-                                torch.tensor(item.mag.degrees)
-                                - torch.rad2deg(mag)
-                                + 180.0,
-                                2.0 * 180.0,
-                            )
-                            - 180.0
-                        )
+            # Refresh the modification time which doubles as the LRU order on disk.
+            os.utime(path)
+        except (OSError, ValueError):
+            # Missing, or evicted by another process in the meantime.
+            return None
+
+        pos = (Angle(radians=data["lat"]), Angle(radians=data["lon"]))
+        self.remember(key, pos)
+        return pos
+
+    def put(self, key, pos):
+        self.remember(key, pos)
+
+        if self.directory is None:
+            return
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"lat": pos[0].radians, "lon": pos[1].radians}, f)
+                size = f.tell()
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        if self.disk_bytes is not None:
+            self.disk_bytes += size
+        if self.disk_bytes is None or self.disk_bytes > self.max_bytes:
+            self.evict()
+
+    def remember(self, key, pos):
+        self.memory[key] = pos
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def evict(self):
+        """Scan the directory and, if it is past max_bytes, evict the least recently
+        used files until it is down to EVICT_TO of max_bytes."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    entry_stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another process in the meantime.
+                    continue
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * self.EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+        self.disk_bytes = total
+
+
+class NumpyNavigationModel:
+    """The NavigationModel objective and its analytic gradient, in NumPy.
+
+    The parameters are the starting latitude and longitude in radians and the common
+    observation error in degrees. Positions along the log are cumulative sums over
+    the movements and the gradient is carried forward with them, so there is no graph
+    to keep around.
+    """
+
+    R_NM = 360.0 * 60.0 / (2.0 * np.pi)
 
-                dist_errors.append((item.star, dist_nm.item()))
+    def __init__(self, starting_pos, log):
+        self.params = np.array([starting_pos[0].radians, starting_pos[1].radians, 0.0])
+
+        self.stars = []
+        legs, gp_lats, gp_lons, alts_deg = [], [], [], []
+        bearings, distances = [], []
+
+        for item in log:
+            if isinstance(item, Observation):
+                self.stars.append(item.star)
+                legs.append(len(bearings))
+                gp_lats.append(item.gp[0].radians)
+                gp_lons.append(item.gp[1].radians)
+                alts_deg.append(item.alt.degrees)
 
             elif isinstance(item, RhumbLineMovement):
-                lat, lon = self.move_rhumb(
-                    origin=(lat, lon),
-                    bearing_rad=torch.tensor(item.bearing.radians),
-                    distance_nm=torch.tensor(item.distance_nm()),
-                )
-                positions.append((Angle(radians=lat.item()), Angle(radians=lon.item())))
+                bearings.append(item.bearing.radians)
+                distances.append(item.distance_nm())
 
             else:
                 raise ValueError(f"Invalid log item: {item}")
 
-        return (positions, dist_errors, loss)
+        # The index of the position after the preceding movements, for each
+        # observation.
+        self.legs = np.array(legs, dtype=int)
+        self.gp = (np.array(gp_lats), np.array(gp_lons))
+        self.alts_deg = np.array(alts_deg)
+        self.bearings_rad = np.array(bearings)
+        self.distances_nm = np.array(distances)
+
+    def loss_and_grad(self):
+        lat0, lon0, observation_error = self.params
+
+        lats, lons, dlons_dlat0 = self.move_rhumb(
+            origin=(lat0, lon0),
+            bearing_rad=self.bearings_rad,
+            distance_nm=self.distances_nm,
+        )
+        pos = (lats[self.legs], lons[self.legs])
+
+        dist_gp_nm, dgp_dlat, dgp_dlon = self.distance_to_gp_nm_grad(pos, self.gp)
+        dist_nm = (90.0 - (self.alts_deg + observation_error)) * 60.0 - dist_gp_nm
+
+        loss = np.sum(np.square(dist_nm))
+        grad = np.array(
+            [
+                np.sum(2.0 * dist_nm * -(dgp_dlat + dgp_dlon * dlons_dlat0[self.legs])),
+                np.sum(2.0 * dist_nm * -dgp_dlon),
+                np.sum(2.0 * dist_nm * -60.0),
+            ]
+        )
+        return (loss, grad)
+
+    def report(self):
+        """The positions along the log and the distance error of each observation."""
+        lat0, lon0, observation_error = self.params
+
+        lats, lons, _ = self.move_rhumb(
+            origin=(lat0, lon0),
+            bearing_rad=self.bearings_rad,
+            distance_nm=self.distances_nm,
+        )
+        dist_nm = self.distance_to_circle_nm(
+            pos=(lats[self.legs], lons[self.legs]),
+            gp=self.gp,
+            alt_deg=self.alts_deg + observation_error,
+        )
+
+        positions = [
+            (Angle(radians=lat), Angle(radians=lon)) for lat, lon in zip(lats, lons)
+        ]
+        dist_errors = list(zip(self.stars, dist_nm.tolist()))
+        return (positions, dist_errors)
 
     @classmethod
     def distance_to_circle_nm(cls, pos, gp, alt_deg):
@@ -238,6 +534,11 @@ class NavigationModel(nn.Module):
     @classmethod
     def distance_to_gp_nm(cls, pos, gp):
         """The distance from pos to the GP"""
+        return cls.distance_to_gp_nm_grad(pos, gp)[0]
+
+    @classmethod
+    def distance_to_gp_nm_grad(cls, pos, gp):
+        """The distance from pos to the GP and its derivatives by pos"""
         lat1, lon1 = pos[0], pos[1]
         lat2, lon2 = gp[0], gp[1]
 
@@ -246,11 +547,19 @@ class NavigationModel(nn.Module):
         dlat = lat2 - lat1
         dlon = lon2 - lon1
 
-        a = torch.square(torch.sin(dlat / 2.0)) + (
-            torch.cos(lat1) * torch.cos(lat2) * torch.square(torch.sin(dlon / 2.0))
+        a = np.square(np.sin(dlat / 2.0)) + (
+            np.cos(lat1) * np.cos(lat2) * np.square(np.sin(dlon / 2.0))
         )
-        distance_rad = 2.0 * torch.arctan2(torch.sqrt(a), torch.sqrt(1.0 - a))
-        return torch.rad2deg(distance_rad) * 60.0
+        distance_rad = 2.0 * np.arctan2(np.sqrt(a), np.sqrt(1.0 - a))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ddist_da = cls.R_NM / np.sqrt(a * (1.0 - a))
+        da_dlat1 = -0.5 * np.sin(dlat) - np.sin(lat1) * np.cos(lat2) * np.square(
+            np.sin(dlon / 2.0)
+        )
+        da_dlon1 = -0.5 * np.cos(lat1) * np.cos(lat2) * np.sin(dlon)
+
+        return (distance_rad * cls.R_NM, ddist_da * da_dlat1, ddist_da * da_dlon1)
 
     @classmethod
     def angle_to_gp(cls, pos, gp):
@@ -259,86 +568,525 @@ class NavigationModel(nn.Module):
         lat2, lon2 = gp[0], gp[1]
 
         # https://www.movable-type.co.uk/scripts/latlong.html#bearing
-        y = torch.sin(lon2 - lon1) * torch.cos(lat2)
-        x = torch.cos(lat1) * torch.sin(lat2) - torch.sin(lat1) * torch.cos(
-            lat2
-        ) * torch.cos(lon2 - lon1)
-        return torch.arctan2(y, x)
+        y = np.sin(lon2 - lon1) * np.cos(lat2)
+        x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(
+            lon2 - lon1
+        )
+        return np.arctan2(y, x)
 
     @classmethod
     def move_rhumb(cls, origin, bearing_rad, distance_nm):
+        """Move along consecutive rhumb lines.
+
+        Returns the latitudes and longitudes before the first and after each movement
+        and the derivatives of the longitudes by the latitude of the origin.
+        """
         lat_o, lon_o = origin
 
         distance_r = distance_nm / cls.R_NM
 
         # https://www.movable-type.co.uk/scripts/latlong.html#rhumb-destination
 
-        lat = lat_o + torch.cos(-bearing_rad) * distance_r
-        if torch.abs(lat) > torch.pi / 2.0:
+        lats = lat_o + np.concatenate(
+            ([0.0], np.cumsum(np.cos(bearing_rad) * distance_r))
+        )
+        lat_from, lat_to = lats[:-1], lats[1:]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mercator_lat_diff = np.log(
+                np.tan(np.pi / 4.0 + lat_to / 2.0)
+                / np.tan(np.pi / 4.0 + lat_from / 2.0)
+            )
+            # Moving along a parallel, use the limit as the difference goes to zero.
+            parallel = np.abs(mercator_lat_diff) < 1e-12
+            lat_ratio = np.where(
+                parallel, np.cos(lat_from), (lat_to - lat_from) / mercator_lat_diff
+            )
+            dratio_dlat_o = np.where(
+                parallel,
+                -np.sin(lat_from),
+                -(lat_to - lat_from)
+                / np.square(mercator_lat_diff)
+                * (1.0 / np.cos(lat_to) - 1.0 / np.cos(lat_from)),
+            )
+
+            dlons = np.sin(bearing_rad) * distance_r / lat_ratio
+            ddlons_dlat_o = -dlons / lat_ratio * dratio_dlat_o
+
+        lons = lon_o + np.concatenate(([0.0], np.cumsum(dlons)))
+        dlons_dlat_o = np.concatenate(([0.0], np.cumsum(ddlons_dlat_o)))
+
+        past_pole = np.flatnonzero(np.abs(lat_to) > np.pi / 2.0)
+        if len(past_pole) > 0:
+            i = past_pole[0]
             raise ValueError(
                 "Tried to go past a pole, origin: %s bearing: %s distance: %.1f NM"
                 % (
-                    format_coord(
-                        (Angle(radians=lat_o.item()), Angle(radians=lon_o.item()))
-                    ),
-                    format_dm(Angle(radians=bearing_rad.item())),
-                    distance_nm,
+                    format_coord((Angle(radians=lats[i]), Angle(radians=lons[i]))),
+                    format_dm(Angle(radians=bearing_rad[i])),
+                    distance_nm[i],
                 )
             )
 
-        mercator_lat_diff = torch.log(
-            torch.tan(torch.pi / 4.0 + lat / 2.0)
-            / torch.tan(torch.pi / 4.0 + lat_o / 2.0)
-        )
-        if abs(mercator_lat_diff) < 1e-12:
-            lat_ratio = torch.cos(lat_o)
-        else:
-            lat_ratio = (lat - lat_o) / mercator_lat_diff
+        return (lats, lons, dlons_dlat_o)
+
+
+class AdamW:
+    """A NumPy port of torch.optim.AdamW with amsgrad for one parameter array."""
+
+    def __init__(self, params, lr, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2):
+        self.params = params
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+        self.weight_decay = weight_decay
+
+        self.steps = 0
+        self.exp_avg = np.zeros_like(params)
+        self.exp_avg_sq = np.zeros_like(params)
+        self.max_exp_avg_sq = np.zeros_like(params)
+
+    def step(self, grad):
+        beta1, beta2 = self.betas
+        self.steps += 1
+
+        self.params *= 1.0 - self.lr * self.weight_decay
+
+        self.exp_avg = beta1 * self.exp_avg + (1.0 - beta1) * grad
+        self.exp_avg_sq = beta2 * self.exp_avg_sq + (1.0 - beta2) * np.square(grad)
+        self.max_exp_avg_sq = np.maximum(self.max_exp_avg_sq, self.exp_avg_sq)
+
+        bias_correction1 = 1.0 - beta1**self.steps
+        bias_correction2 = 1.0 - beta2**self.steps
+
+        denom = np.sqrt(self.max_exp_avg_sq) / np.sqrt(bias_correction2) + self.eps
+        self.params -= self.lr / bias_correction1 * self.exp_avg / denom
+
+
+@functools.lru_cache(maxsize=None)
+def torch_navigation_model():
+    """Import torch and define NavigationModel on first use.
+
+    Importing torch takes seconds and a lot of memory, so it is only done when the
+    torch backend is selected.
+    """
+    import torch
+    import torch.nn as nn
+    import torch.utils.checkpoint
+
+    class NavigationModel(nn.Module):
+        """A local optimization model which takes observer movement into account.
+
+        Like NumpyNavigationModel, the log is held as tensors and evaluated with vector
+        operations. If chunk_size is given, the log is evaluated in segments of that
+        many items with gradient checkpointing. Only the positions at the segment
+        boundaries are kept in the autograd graph, so its size no longer grows with the
+        length of the log. Each segment is evaluated twice at a fixed cost of some
+        hundred tensor operations, so chunk_size only pays off at hundreds of thousands
+        of items; below that the whole graph takes a few megabytes.
+        """
+
+        R_NM = 360.0 * 60.0 / (2.0 * torch.pi)
+
+        def __init__(self, starting_pos, log, chunk_size=None):
+            super().__init__()
+
+            if chunk_size is not None and chunk_size < 1:
+                raise ValueError(f"Invalid chunk size: {chunk_size}")
+
+            self.chunk_size = chunk_size
+            self.starting_lat = nn.Parameter(torch.tensor(starting_pos[0].radians))
+            self.starting_lon = nn.Parameter(torch.tensor(starting_pos[1].radians))
+            # Assume a small common error in all observations.
+            self.observation_error = nn.Parameter(torch.tensor(0.0))
+
+            self.stars = []
+            observation_items, legs, gp_lats, gp_lons, alts_deg = [], [], [], [], []
+            movement_items, bearings, distances = [], [], []
+
+            for i, item in enumerate(log):
+                if isinstance(item, Observation):
+                    self.stars.append(item.star)
+                    observation_items.append(i)
+                    legs.append(len(bearings))
+                    gp_lats.append(item.gp[0].radians)
+                    gp_lons.append(item.gp[1].radians)
+                    alts_deg.append(item.alt.degrees)
+
+                elif isinstance(item, RhumbLineMovement):
+                    movement_items.append(i)
+                    bearings.append(item.bearing.radians)
+                    distances.append(item.distance_nm())
+
+                else:
+                    raise ValueError(f"Invalid log item: {item}")
+
+            # The index of the position after the preceding movements, for each
+            # observation.
+            self.legs = torch.tensor(legs, dtype=torch.long)
+            self.gp = (torch.tensor(gp_lats), torch.tensor(gp_lons))
+            self.alts_deg = torch.tensor(alts_deg)
+            self.bearings_rad = torch.tensor(bearings)
+            self.distances_nm = torch.tensor(distances)
+
+            # The observations and the movements in each segment of the log.
+            step = chunk_size if chunk_size is not None else max(len(log), 1)
+            bounds = list(range(0, len(log), step)) + [len(log)]
+            observation_bounds = np.searchsorted(observation_items, bounds).tolist()
+            movement_bounds = np.searchsorted(movement_items, bounds).tolist()
+            self.segments = [
+                (slice(*observations), slice(*movements))
+                for observations, movements in zip(
+                    zip(observation_bounds[:-1], observation_bounds[1:]),
+                    zip(movement_bounds[:-1], movement_bounds[1:]),
+                )
+            ]
+
+        def forward(self):
+            """The sum of the squared distances to the circles of equal altitude."""
+            loss = torch.tensor(0.0)
+
+            lat, lon = self.starting_lat, self.starting_lon
+            for observations, movements in self.segments:
+                if self.chunk_size is None:
+                    result = self.forward_segment(lat, lon, observations, movements)
+                else:
+                    # Drop the segment's intermediate graph and recompute it during the
+                    # backward pass.
+                    result = torch.utils.checkpoint.checkpoint(
+                        self.forward_segment,
+                        lat,
+                        lon,
+                        observations,
+                        movements,
+                        use_reentrant=False,
+                    )
+                lat, lon, segment_loss = result
+                loss = loss + segment_loss
+
+            return loss
+
+        def forward_segment(self, lat, lon, observations, movements):
+            """Evaluate a part of the log starting at (lat, lon).
+
+            observations and movements are slices of the observations and the movements
+            in the segment. Returns the position at the end of the segment and the loss
+            of the segment.
+            """
+            lats, lons = self.move_rhumb(
+                origin=(lat, lon),
+                bearing_rad=self.bearings_rad[movements],
+                distance_nm=self.distances_nm[movements],
+            )
+            legs = self.legs[observations] - movements.start
 
-        lon = lon_o - torch.sin(-bearing_rad) * distance_r / lat_ratio
+            dist_nm = self.distance_to_circle_nm(
+                pos=(lats[legs], lons[legs]),
+                gp=(self.gp[0][observations], self.gp[1][observations]),
+                alt_deg=self.alts_deg[observations] + self.observation_error,
+            )
 
-        return (lat, lon)
+            # Could use the magnetic heading as well, see angle_to_gp(); not sure if
+            # it's helpful. It could be harmful given bad measurements. What weight
+            # factor to use?
+
+            return (lats[-1], lons[-1], torch.sum(torch.square(dist_nm)))
+
+        def report(self):
+            """The positions along the log, see NumpyNavigationModel.report()."""
+            with torch.no_grad():
+                lats, lons = self.move_rhumb(
+                    origin=(self.starting_lat, self.starting_lon),
+                    bearing_rad=self.bearings_rad,
+                    distance_nm=self.distances_nm,
+                )
+                dist_nm = self.distance_to_circle_nm(
+                    pos=(lats[self.legs], lons[self.legs]),
+                    gp=self.gp,
+                    alt_deg=self.alts_deg + self.observation_error,
+                )
+
+            positions = [
+                (Angle(radians=lat), Angle(radians=lon))
+                for lat, lon in zip(lats.tolist(), lons.tolist())
+            ]
+            dist_errors = list(zip(self.stars, dist_nm.tolist()))
+            return (positions, dist_errors)
+
+        @classmethod
+        def distance_to_circle_nm(cls, pos, gp, alt_deg):
+            """The distance from pos to the circle of equal altitude"""
+            return (90.0 - alt_deg) * 60.0 - cls.distance_to_gp_nm(pos, gp)
+
+        @classmethod
+        def distance_to_gp_nm(cls, pos, gp):
+            """The distance from pos to the GP"""
+            lat1, lon1 = pos[0], pos[1]
+            lat2, lon2 = gp[0], gp[1]
+
+            # https://www.movable-type.co.uk/scripts/latlong.html#ortho-dist
+
+            dlat = lat2 - lat1
+            dlon = lon2 - lon1
+
+            a = torch.square(torch.sin(dlat / 2.0)) + (
+                torch.cos(lat1) * torch.cos(lat2) * torch.square(torch.sin(dlon / 2.0))
+            )
+            distance_rad = 2.0 * torch.arctan2(torch.sqrt(a), torch.sqrt(1.0 - a))
+            return torch.rad2deg(distance_rad) * 60.0
+
+        @classmethod
+        def angle_to_gp(cls, pos, gp):
+            """The bearing from pos to the GP (in radians)"""
+            lat1, lon1 = pos[0], pos[1]
+            lat2, lon2 = gp[0], gp[1]
+
+            # https://www.movable-type.co.uk/scripts/latlong.html#bearing
+            y = torch.sin(lon2 - lon1) * torch.cos(lat2)
+            x = torch.cos(lat1) * torch.sin(lat2) - torch.sin(lat1) * torch.cos(
+                lat2
+            ) * torch.cos(lon2 - lon1)
+            return torch.arctan2(y, x)
+
+        @classmethod
+        def move_rhumb(cls, origin, bearing_rad, distance_nm):
+            """Move along consecutive rhumb lines.
+
+            Returns the latitudes and longitudes before the first and after each
+            movement.
+            """
+            lat_o, lon_o = origin
+
+            distance_r = distance_nm / cls.R_NM
+
+            # https://www.movable-type.co.uk/scripts/latlong.html#rhumb-destination
+
+            lats = torch.cat(
+                (
+                    lat_o.reshape(1),
+                    lat_o + torch.cumsum(torch.cos(bearing_rad) * distance_r, 0),
+                )
+            )
+            lat_from, lat_to = lats[:-1], lats[1:]
+
+            mercator_lat_diff = torch.log(
+                torch.tan(torch.pi / 4.0 + lat_to / 2.0)
+                / torch.tan(torch.pi / 4.0 + lat_from / 2.0)
+            )
+            # Moving along a parallel, use the limit as the difference goes to zero. The
+            # difference is replaced before dividing so that the unused branch doesn't
+            # turn the gradient into NaN.
+            parallel = torch.abs(mercator_lat_diff) < 1e-12
+            mercator_lat_diff = torch.where(
+                parallel, torch.ones_like(mercator_lat_diff), mercator_lat_diff
+            )
+            lat_ratio = torch.where(
+                parallel, torch.cos(lat_from), (lat_to - lat_from) / mercator_lat_diff
+            )
+
+            lons = torch.cat(
+                (
+                    lon_o.reshape(1),
+                    lon_o
+                    + torch.cumsum(torch.sin(bearing_rad) * distance_r / lat_ratio, 0),
+                )
+            )
+
+            past_pole = torch.nonzero(torch.abs(lat_to) > torch.pi / 2.0)
+            if len(past_pole) > 0:
+                i = past_pole[0].item()
+                raise ValueError(
+                    "Tried to go past a pole, origin: %s bearing: %s distance: %.1f NM"
+                    % (
+                        format_coord(
+                            (
+                                Angle(radians=lats[i].item()),
+                                Angle(radians=lons[i].item()),
+                            )
+                        ),
+                        format_dm(Angle(radians=bearing_rad[i].item())),
+                        distance_nm[i].item(),
+                    )
+                )
+
+            return (lats, lons)
+
+    return NavigationModel
+
+
+def __getattr__(name):
+    if name == "NavigationModel":
+        return torch_navigation_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# The 57 selected stars of the Nautical Almanac and Polaris, by the names in
+# named_star_dict, see star_hip(). Acamar, Menkar and Zubenelgenubi are missing
+# from it.
+NAVIGATIONAL_STARS = (
+    "Alpheratz",
+    "Ankaa",
+    "Schedar",
+    "Diphda",
+    "Achernar",
+    "Hamal",
+    "Polaris",
+    "Mirfak",
+    "Aldebaran",
+    "Rigel",
+    "Capella",
+    "Bellatrix",
+    "Elnath",
+    "Alnilam",
+    "Betelgeuse",
+    "Canopus",
+    "Sirius",
+    "Adhara",
+    "Procyon",
+    "Pollux",
+    "Avior",
+    "Suhail",
+    "Miaplacidus",
+    "Alphard",
+    "Regulus",
+    "Dubhe",
+    "Denebola",
+    "Gienah",
+    "Acrux",
+    "Gacrux",
+    "Alioth",
+    "Spica",
+    "Alkaid",
+    "Hadar",
+    "Menkent",
+    "Arcturus",
+    "Rigil Kentaurus",
+    "Kochab",
+    "Alphecca",
+    "Antares",
+    "Atria",
+    "Sabik",
+    "Shaula",
+    "Rasalhague",
+    "Etamin",
+    "Kaus Australis",
+    "Vega",
+    "Nunki",
+    "Altair",
+    "Peacock",
+    "Deneb",
+    "Enif",
+    "Alnair",
+    "Fomalhaut",
+    "Markab",
+)
+
+# Navigational stars whose names named_star_dict gives to another star, by their
+# Hipparcos numbers. It has Gienah as ε Cygni and Markab as κ Velorum.
+NAVIGATIONAL_STAR_HIP = {
+    "Gienah": 59803,  # γ Corvi
+    "Markab": 113963,  # α Pegasi
+}
+
+
+def star_hip(star_name):
+    """The Hipparcos number of a star, as the Nautical Almanac names it."""
+    if star_name in NAVIGATIONAL_STAR_HIP:
+        return NAVIGATIONAL_STAR_HIP[star_name]
+    return named_star_dict[star_name]
+
+
+@dataclass
+class SightPlan:
+    time: Any
+    stars: Tuple[str, str, str]
+    alts: Tuple[Angle, Angle, Angle]
+    azimuths: Tuple[Angle, Angle, Angle]
+    # The inverse condition number of the fix; 1/√2 for azimuths 120° apart.
+    score: float
+
+
+@dataclass
+class LocalFit:
+    positions: list
+    dist_errors: list
+    observation_error: Angle
+    losses: list
 
 
 class CelestialFix:
+    # Bump when a change would make previously cached fixes invalid.
+    CACHE_VERSION = 1
+
+    # The local fix backends. torch is only imported if selected.
+    BACKENDS = ("numpy", "torch")
+
+    # Beyond these, the plane intersection is too sensitive to errors in the altitudes
+    # to start the local fix from, see fix_global_rough().
+    MAX_CONDITION = 20.0
+    MAX_RADIUS_ERROR = 0.05
+
     ephemeris = None
     stars_dataframe = None
+    timescale = None
+
+    def __init__(
+        self,
+        observation_params=ObservationParams(),
+        *,
+        backend="numpy",
+        chunk_size=None,
+        cache=None,
+    ):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown backend: {backend}")
 
-    def __init__(self, observation_params=ObservationParams()):
         self.observation_params = observation_params
+        self.backend = backend
+        # Only used by the torch backend; the numpy backend keeps no graph.
+        self.chunk_size = chunk_size
+        self.cache = cache
 
         self.logger = logging.getLogger("CelestialFix")
 
-        if self.ephemeris is None:
-            self.logger.info("Loading ephemeris")
-            self.__class__.ephemeris = load("de421.bsp")
-
-        if self.stars_dataframe is None:
-            self.logger.info("Loading star catalog")
-            with load.open(hipparcos.URL) as f:
-                self.__class__.stars_dataframe = hipparcos.load_dataframe(f)
-
-        self.ts = load.timescale()
+        if self.timescale is None:
+            self.__class__.timescale = load.timescale()
+        self.ts = self.timescale
 
         self.bearing = Angle(degrees=0.0)
         self.speed_knots = 0.0
         self.time = None
         self.log = []
+        # The details of the last fix_local_fine().
+        self.local_fit = None
 
     def set_bearing_speed(self, bearing_deg, speed_knots):
         self.bearing = Angle(degrees=bearing_deg)
         self.speed_knots = speed_knots
 
     def add_observation(
-        self, star, time, alt_sextant, *, mag=None, observation_params=None
+        self, star, time, alt_sextant, *, mag=None, limb=None, observation_params=None
     ):
-        alt_sextant = Angle(degrees=alt_sextant)
-        if mag is not None:
-            mag = Angle(degrees=mag)
+        """Add a sight of a star or of a body in BODIES.
+
+        For the Sun and the Moon, limb is "lower" or "upper" if the sight was of that
+        limb rather than the center. The semidiameter is then computed from the
+        ephemeris, so it must not also be given as semidiameter_correction_min.
+        """
+        if limb is not None and star not in LIMB_BODIES:
+            raise ValueError(f"Only the Sun and the Moon have a limb: {star}")
 
         if observation_params is None:
             observation_params = self.observation_params
 
+        if limb is not None and observation_params.semidiameter_correction_min != 0.0:
+            # Both would correct for the semidiameter.
+            raise ValueError("Use either limb or semidiameter_correction_min, not both")
+
+        alt_sextant = Angle(degrees=alt_sextant)
+        if mag is not None:
+            mag = Angle(degrees=mag)
+
         if self.time is not None and self.speed_knots != 0.0:
             diff_hours = (time - self.time) * 24.0
             if diff_hours < 0.0:
@@ -369,8 +1117,6 @@ class CelestialFix:
             "  %s Hs: %s Ho: %s", star, format_dm(alt_sextant), format_dm(alt_observed)
         )
 
-        gp = self.star_gp(star, time)
-        self.logger.info("  %s GP: %s", star, format_coord(gp))
         self.logger.info(
             "  %s dist: %.1f NM", star, (90.0 - alt_observed.degrees) * 60.0
         )
@@ -378,15 +1124,123 @@ class CelestialFix:
         if mag is not None:
             self.logger.info("  %s mag: %s", star, format_dm(mag))
 
-        obs = Observation(star=star, gp=gp, alt=alt_observed, mag=mag)
+        obs = Observation(
+            star=star,
+            alt=alt_observed,
+            time=time,
+            mag=mag,
+            limb=limb,
+            observation_params=observation_params,
+        )
         self.log.append(obs)
 
+    def resolve_gps(self):
+        pending = [
+            item
+            for item in self.log
+            if isinstance(item, Observation) and item.gp is None
+        ]
+
+        # All the sights of a body are computed at once.
+        for body in sorted({item.star for item in pending if item.star in BODIES}):
+            items = [item for item in pending if item.star == body]
+            times = self.ts.tt_jd(
+                np.array([item.time.whole for item in items]),
+                np.array([item.time.tt_fraction for item in items]),
+            )
+            lats, lons, sds, hps = self.body_gps(body, times)
+
+            for item, lat, lon, sd, hp in zip(items, lats, lons, sds, hps):
+                item.gp = (Angle(radians=lat), norm_angle(Angle(radians=lon)))
+                self.logger.info("  %s GP: %s", body, format_coord(item.gp))
+
+                sd, hp = Angle(radians=sd), Angle(radians=hp)
+                item.alt_uncorrected = item.alt
+                item.alt = item.observation_params.body_correction(
+                    item.alt, sd, hp, item.limb
+                )
+                self.logger.info(
+                    "  %s SD: %s HP: %s Ho: %s",
+                    body,
+                    format_dm(sd),
+                    format_dm(hp),
+                    format_dm(item.alt),
+                )
+
+        for item in pending:
+            if item.gp is None:
+                item.gp = self.star_gp(item.star, item.time)
+                self.logger.info("  %s GP: %s", item.star, format_coord(item.gp))
+
+    def cache_key(self):
+        """A hash of everything the fix depends on, for use with FixCache."""
+        log = []
+        for item in self.log:
+            if isinstance(item, Observation):
+                log.append(
+                    {
+                        "star": item.star,
+                        "ut1": item.time.ut1,
+                        "alt": (item.alt_uncorrected or item.alt).radians,
+                        "mag": None if item.mag is None else item.mag.radians,
+                        "limb": item.limb,
+                    }
+                )
+
+            elif isinstance(item, RhumbLineMovement):
+                log.append(
+                    {
+                        "bearing": item.bearing.radians,
+                        "speed_knots": item.speed_knots,
+                        "duration_hours": item.duration_hours,
+                    }
+                )
+
+            else:
+                raise ValueError(f"Invalid log item: {item}")
+
+        # The corrected altitudes already account for the ObservationParams.
+        canonical = json.dumps(
+            {
+                "version": self.CACHE_VERSION,
+                "log": log,
+                # chunk_size only affects memory use, not the fix.
+                "solver": {"backend": self.backend},
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
     def fix(self):
+        key = None
+        if self.cache is not None:
+            key = self.cache_key()
+            pos = self.cache.get(key)
+            if pos is not None:
+                self.logger.info("Cached fix: %s", format_coord(pos))
+                return pos
+
         rough_pos = self.fix_global_rough()
-        return self.fix_local_fine(rough_pos)
+        pos = self.fix_local_fine(rough_pos)
+
+        if key is not None:
+            self.cache.put(key, pos)
+
+        return pos
 
     def fix_global_rough(self):
+        """Rough global fix from the intersection of the circles of equal altitude.
+
+        If plane_intersection has no unique solution, or the GPs are so close to one
+        great circle (condition number above MAX_CONDITION) or the altitudes disagree
+        so much (radius off by more than MAX_RADIUS_ERROR) that the intersection could
+        be far off, falls back to fix_global_grid(). With two sights, its best
+        solutions are equally good and the one by cost alone is arbitrary; see
+        pick_solution().
+        """
         self.logger.info("Rough global fix")
+        self.resolve_gps()
 
         alts = np.zeros((1, 0))
         gps = np.zeros((2, 0))
@@ -403,18 +1257,45 @@ class CelestialFix:
             else:
                 raise ValueError(f"Invalid log item: {item}")
 
+        if gps.shape[1] < 2:
+            raise ValueError("A fix needs at least two observations")
+
         gp_vecs = coord_to_vector_m(gps)
 
         # A point on the plane whose intersection with the sphere is the circle of equal
         # altitude.
         ps = np.sin(alts) * gp_vecs
 
-        point = plane_intersection(ps, gp_vecs)
+        try:
+            point = plane_intersection(ps, gp_vecs)
+
+            # With no errors, the point would be on a unit sphere.
+            norm = np.linalg.norm(point)
+            self.logger.info("  Radius (1 is optimal): %f", norm)
+
+            # An error in the altitudes moves the point by up to about the condition
+            # number times as much, mostly off the great circle through the GPs.
+            condition = np.linalg.cond(gp_vecs.T)
+            self.logger.info("  Condition number: %f", condition)
+
+            if condition > self.MAX_CONDITION:
+                raise ValueError("GPs close to one great circle")
+            if abs(norm - 1.0) > self.MAX_RADIUS_ERROR:
+                raise ValueError("Altitudes disagree")
+        except ValueError as e:
+            # Two sights or GPs on or close to one great circle; there is more than one
+            # solution or the intersection is unreliable.
+            self.logger.info("  Plane intersection: %s", e)
+            solutions = self.fix_global_grid()
+            self.logger.info(
+                f"  Sphere search solution{'' if len(solutions) == 1 else 's'}:"
+            )
+            for pos, cost in solutions:
+                self.logger.info("    %s (cost: %g)", format_coord(pos), cost)
 
-        # With no errors, the point would be on a unit sphere. Project it onto one.
-        norm = np.linalg.norm(point)
-        self.logger.info("  Radius (1 is optimal): %f", norm)
+            return self.pick_solution(solutions)
 
+        # Project the point onto the unit sphere.
         point /= norm
 
         pos = vector_to_coord(point)
@@ -422,21 +1303,152 @@ class CelestialFix:
 
         return pos
 
+    def fix_global_grid(self, *, subdivisions=4, min_separation_nm=10.0):
+        """Rough global fix by a hierarchical search over the whole sphere.
+
+        The sum of squared distances to the circles of equal altitude is evaluated on
+        an icosphere, and then on ever finer local grids around each of its local
+        minima. Movement is ignored like in fix_global_rough. Returns every minimum
+        found as (pos, cost), best first, where cost is in square NM.
+        """
+        self.resolve_gps()
+
+        gp_lats, gp_lons, alts_deg = [], [], []
+        for item in self.log:
+            if isinstance(item, Observation):
+                gp_lats.append(item.gp[0].radians)
+                gp_lons.append(item.gp[1].radians)
+                alts_deg.append(item.alt.degrees)
+
+            elif isinstance(item, RhumbLineMovement):
+                # Ignore movement.
+                pass
+
+            else:
+                raise ValueError(f"Invalid log item: {item}")
+
+        if len(alts_deg) < 2:
+            raise ValueError("A fix needs at least two observations")
+
+        gp = (np.array(gp_lats), np.array(gp_lons))
+        alts_deg = np.array(alts_deg)
+
+        def cost(vecs):
+            """The cost at each of the unit vectors in a ...x3 array."""
+            lat = np.arcsin(np.clip(vecs[..., 2], -1.0, 1.0))
+            lon = np.arctan2(vecs[..., 1], vecs[..., 0])
+            dist_nm = NumpyNavigationModel.distance_to_circle_nm(
+                pos=(lat[..., np.newaxis], lon[..., np.newaxis]),
+                gp=gp,
+                alt_deg=alts_deg,
+            )
+            return np.sum(np.square(dist_nm), axis=-1)
+
+        vecs, edges = icosphere(subdivisions)
+        vecs = vecs.T
+        costs = cost(vecs)
+
+        # Vertices which are no worse than any of their neighbours.
+        neighbour_min = np.full(costs.shape, np.inf)
+        np.minimum.at(neighbour_min, edges[0], costs[edges[1]])
+        np.minimum.at(neighbour_min, edges[1], costs[edges[0]])
+        points = vecs[costs <= neighbour_min]
+
+        # Refine with a 5x5 grid in the tangent plane of each point, halving the
+        # spacing each round until it is well below 0.1′.
+        spacing = np.max(np.arccos(np.sum(vecs[edges[0]] * vecs[edges[1]], axis=1)))
+        offsets = np.linspace(-1.0, 1.0, 5)
+        offsets_u, offsets_v = [o.ravel() for o in np.meshgrid(offsets, offsets)]
+        while spacing > 1e-7:
+            helper = np.where(
+                np.abs(points[:, [2]]) < 0.9, [[0.0, 0.0, 1.0]], [[1.0, 0.0, 0.0]]
+            )
+            u = np.cross(helper, points)
+            u /= np.linalg.norm(u, axis=1, keepdims=True)
+            v = np.cross(points, u)
+
+            grid = (
+                points[:, np.newaxis, :]
+                + spacing * offsets_u[np.newaxis, :, np.newaxis] * u[:, np.newaxis, :]
+                + spacing * offsets_v[np.newaxis, :, np.newaxis] * v[:, np.newaxis, :]
+            )
+            grid /= np.linalg.norm(grid, axis=2, keepdims=True)
+
+            best = np.argmin(cost(grid), axis=1)
+            points = grid[np.arange(len(points)), best]
+            spacing /= 2.0
+
+        costs = cost(points)
+
+        # Separate searches may have converged on the same minimum.
+        solutions = []
+        min_separation_rad = min_separation_nm / NumpyNavigationModel.R_NM
+        for i in np.argsort(costs):
+            if all(
+                np.arccos(np.clip(np.dot(points[i], points[j]), -1.0, 1.0))
+                >= min_separation_rad
+                for j, _ in solutions
+            ):
+                solutions.append((i, costs[i]))
+
+        return [
+            (vector_to_coord(points[i].reshape(3, 1).copy()), c) for i, c in solutions
+        ]
+
+    def pick_solution(self, solutions, max_rms_nm=1.0):
+        """Pick one of the solutions of fix_global_grid().
+
+        Solutions within max_rms_nm of the best one are equally plausible. Among
+        them, the one which agrees best with the bearings (mag) of the observations
+        is picked. Without bearings, the choice is arbitrary and logged as such.
+        """
+        observations = [item for item in self.log if isinstance(item, Observation)]
+        max_cost = solutions[0][1] + len(observations) * max_rms_nm**2
+        ambiguous = [pos for pos, cost in solutions if cost <= max_cost]
+        if len(ambiguous) == 1:
+            return ambiguous[0]
+
+        self.logger.warning(
+            "  Ambiguous: %d solutions with cost < %g", len(ambiguous), max_cost
+        )
+
+        bearings = [item for item in observations if item.mag is not None]
+        if len(bearings) == 0:
+            self.logger.warning(
+                "  No bearings to tell them apart, using %s", format_coord(ambiguous[0])
+            )
+            return ambiguous[0]
+
+        mag_deg = np.array([item.mag.degrees for item in bearings])
+        gp = (
+            np.array([item.gp[0].radians for item in bearings]),
+            np.array([item.gp[1].radians for item in bearings]),
+        )
+
+        bearing_errors = []
+        for pos in ambiguous:
+            angle = NumpyNavigationModel.angle_to_gp(
+                (pos[0].radians, pos[1].radians), gp
+            )
+            diff = np.mod(mag_deg - np.rad2deg(angle) + 180.0, 360.0) - 180.0
+            bearing_errors.append(np.sqrt(np.mean(np.square(diff))))
+
+        best = int(np.argmin(bearing_errors))
+        self.logger.info(
+            "  Using %s, bearings off by %.1f° (RMS)",
+            format_coord(ambiguous[best]),
+            bearing_errors[best],
+        )
+        return ambiguous[best]
+
     def fix_local_fine(self, pos):
         self.logger.info("Fine local fix")
+        self.resolve_gps()
 
-        model = NavigationModel(pos, self.log)
-        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4, amsgrad=True)
-        scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, 0.99)
-
-        losses = []
-        for i in range(1000):
-            optimizer.zero_grad()
-            positions, dist_errors, loss = model()
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
-            losses.append(loss.item())
+        if self.backend == "torch":
+            positions, dist_errors, observation_error, losses = self.fit_torch(pos)
+        else:
+            positions, dist_errors, observation_error, losses = self.fit_numpy(pos)
 
         self.logger.debug("  Losses: %s", losses)
         self.logger.info("  Loss: %g (after %d iterations)", losses[-1], len(losses))
@@ -444,7 +1456,13 @@ class CelestialFix:
         # plt.plot(losses)
         # plt.pause(15)
 
-        e = Angle(degrees=model.observation_error.item())
+        e = Angle(degrees=observation_error)
+        self.local_fit = LocalFit(
+            positions=positions,
+            dist_errors=dist_errors,
+            observation_error=e,
+            losses=losses,
+        )
         self.logger.info("  Estimated observation error: %s", format_dm(e, "↑", "↓"))
 
         self.logger.info(
@@ -460,12 +1478,202 @@ class CelestialFix:
 
         return positions[-1]
 
+    def fit_numpy(self, pos):
+        model = NumpyNavigationModel(pos, self.log)
+        optimizer = AdamW(model.params, lr=1e-4)
+
+        losses = []
+        for i in range(1000):
+            loss, grad = model.loss_and_grad()
+            optimizer.step(grad)
+            optimizer.lr *= 0.99
+            losses.append(loss)
+
+        positions, dist_errors = model.report()
+        return (positions, dist_errors, model.params[2], losses)
+
+    def fit_torch(self, pos):
+        import torch
+
+        NavigationModel = torch_navigation_model()
+
+        model = NavigationModel(pos, self.log, chunk_size=self.chunk_size)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4, amsgrad=True)
+        scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, 0.99)
+
+        losses = []
+        for i in range(1000):
+            optimizer.zero_grad()
+            loss = model()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            losses.append(loss.item())
+
+        positions, dist_errors = model.report()
+        return (positions, dist_errors, model.observation_error.item(), losses)
+
     def ut1(self, year, month, day, hour=0, minute=0, second=0, *, tz=0):
         return self.ts.ut1(year, month, day, hour - tz, minute, second)
 
+    def load_catalogs(self):
+        if self.ephemeris is None:
+            self.logger.info("Loading ephemeris")
+            self.__class__.ephemeris = load("de421.bsp")
+
+        if self.stars_dataframe is None:
+            self.logger.info("Loading star catalog")
+            with load.open(hipparcos.URL) as f:
+                self.__class__.stars_dataframe = hipparcos.load_dataframe(f)
+
+    def body_gps(self, body, times):
+        """The GPs of a solar system body at many times.
+
+        Returns the latitudes and longitudes of the GPs, the semidiameters and the
+        horizontal parallaxes as arrays in radians. Skyfield memory maps the
+        ephemeris and keeps the segments it has read, so this is one vectorized
+        evaluation.
+        """
+        self.load_catalogs()
+
+        name, radius_km = BODIES[body]
+        earth = self.ephemeris["earth"]
+        astrometric = earth.at(times).observe(self.ephemeris[name])
+        ra, dec, distance = astrometric.apparent().radec("date")
+
+        gha = np.mod((times.gast - ra.hours) * 15.0, 360.0)
+
+        semidiameters = np.arcsin(radius_km / distance.km)
+        horizontal_parallaxes = np.arcsin(EARTH_RADIUS_KM / distance.km)
+
+        return (dec.radians, np.deg2rad(-gha), semidiameters, horizontal_parallaxes)
+
+    def star_gps(self, star_names, times):
+        """The GPs of many stars at many times, as (lats, lons) arrays in radians.
+
+        The arrays are indexed by star and time. The apparent positions are
+        computed once for the middle time, which is accurate to well below 0.1′
+        within a few hours; only the sidereal time is evaluated for each time.
+        """
+        self.load_catalogs()
+
+        earth = self.ephemeris["earth"]
+        df = self.stars_dataframe.loc[[star_hip(n) for n in star_names]]
+        stars = Star.from_dataframe(df)
+        astrometric = earth.at(times[len(times) // 2]).observe(stars)
+        ra, dec, _distance = astrometric.apparent().radec("date")
+
+        gha = (times.gast[np.newaxis, :] - ra.hours[:, np.newaxis]) * 15.0
+        lats = np.broadcast_to(dec.radians[:, np.newaxis], gha.shape)
+        lons = np.deg2rad(-gha)
+
+        return (lats, lons)
+
+    def plan_sights(
+        self,
+        dr_pos,
+        start,
+        end,
+        *,
+        step_minutes=5.0,
+        min_alt_deg=15.0,
+        max_alt_deg=75.0,
+        max_magnitude=3.0,
+        min_azimuth_spread_deg=30.0,
+        count=5,
+    ):
+        """Rank star triples to shoot from dr_pos between the times start and end.
+
+        Every triple of navigational stars is evaluated on a time grid. A triple
+        qualifies at a time if all of its stars are within the altitude band and
+        their azimuths are at least min_azimuth_spread_deg apart. It is scored by how
+        well conditioned the fix for the position and a common observation error
+        would be. Returns the count best triples, each at its best time.
+        """
+        # Round first so that a whole number of steps is not bumped up by float error.
+        steps = np.ceil(np.round((end - start) * 24.0 * 60.0 / step_minutes, 6))
+        times = self.ts.linspace(start, end, max(1, int(steps)) + 1)
+
+        self.load_catalogs()
+        star_names = [
+            name
+            for name in NAVIGATIONAL_STARS
+            if self.stars_dataframe.loc[star_hip(name), "magnitude"] <= max_magnitude
+        ]
+
+        gp_lats, gp_lons = self.star_gps(star_names, times)
+        dr = (dr_pos[0].radians, dr_pos[1].radians)
+        alts_deg = (
+            90.0 - NumpyNavigationModel.distance_to_gp_nm(dr, (gp_lats, gp_lons)) / 60.0
+        )
+        azimuths_deg = np.mod(
+            np.rad2deg(NumpyNavigationModel.angle_to_gp(dr, (gp_lats, gp_lons))), 360.0
+        )
+
+        # Only consider triples of stars which are in the altitude band at some time.
+        visible = (alts_deg >= min_alt_deg) & (alts_deg <= max_alt_deg)
+        candidates = np.flatnonzero(np.any(visible, axis=1))
+        triples = np.array(list(itertools.combinations(candidates, 3)), dtype=int)
+        if len(triples) == 0:
+            return []
+
+        # Indexed by triple, star in the triple and time.
+        ok = np.all(visible[triples], axis=1)
+        triple_azimuths = azimuths_deg[triples]
+        for i, j in [(0, 1), (0, 2), (1, 2)]:
+            diff = triple_azimuths[:, i] - triple_azimuths[:, j]
+            spread = np.abs(np.mod(diff + 180.0, 360.0) - 180.0)
+            ok &= spread >= min_azimuth_spread_deg
+
+        # The plane_intersection matrix itself only rotates with the earth, so use the
+        # local linearization of distance_to_circle_nm by north, east and the common
+        # observation error instead.
+        triple_idx, time_idx = np.nonzero(ok)
+        az = np.deg2rad(triple_azimuths[triple_idx, :, time_idx])
+        m = np.stack((np.cos(az), np.sin(az), np.ones_like(az)), axis=-1)
+        sv = np.linalg.svd(m, compute_uv=False)
+
+        scores = np.full(ok.shape, -np.inf)
+        scores[triple_idx, time_idx] = sv[:, -1] / sv[:, 0]
+
+        best_times = np.argmax(scores, axis=1)
+        best_scores = scores[np.arange(len(triples)), best_times]
+
+        plans = []
+        for k in np.argsort(-best_scores)[:count]:
+            if not np.isfinite(best_scores[k]):
+                break
+
+            t = best_times[k]
+            stars = triples[k]
+            plans.append(
+                SightPlan(
+                    time=times[t],
+                    stars=tuple(star_names[i] for i in stars),
+                    alts=tuple(Angle(degrees=alts_deg[i, t]) for i in stars),
+                    azimuths=tuple(Angle(degrees=azimuths_deg[i, t]) for i in stars),
+                    score=best_scores[k],
+                )
+            )
+
+        for plan in plans:
+            self.logger.info(
+                "  %s %.3f: %s",
+                plan.time.ut1_strftime(),
+                plan.score,
+                ", ".join(
+                    f"{star} {format_dm(alt)} {format_dm(az)}"
+                    for star, alt, az in zip(plan.stars, plan.alts, plan.azimuths)
+                ),
+            )
+
+        return plans
+
     def star_gp(self, star_name, time):
+        self.load_catalogs()
+
         earth = self.ephemeris["earth"]
-        df = self.stars_dataframe.loc[named_star_dict[star_name]]
+        df = self.stars_dataframe.loc[star_hip(star_name)]
         if df is None:
             raise ValueError(f"Unknown star: {star_name}")
         star = Star.from_dataframe(df)
@@ -485,6 +1693,211 @@ class CelestialFix:
         return (lat, lon)
 
 
+class FixServer:
+    """A resident service which reduces sight sets sent as JSON lines.
+
+    The ephemeris and star catalog are loaded once up front. Requests go through two
+    stages with a thread each, so the GPs of a request are computed while the
+    previous one is being solved. Replies are sent in the order of the requests.
+
+    A request looks like:
+
+        {"id": 1, "observation_params": {"eye_height_m": 2},
+         "sights": [{"star": "Vega", "time": [2022, 4, 9, 0, 28, 0], "tz": -4,
+                     "alt": 64.69, "bearing": 0, "speed_knots": 12}]}
+
+    Replies have "cached" set if the fix came from the cache, in which case the
+    diagnostics of the local fix are not included.
+
+    bearing and speed_knots set the course from that sight on. Sights of the Sun and
+    the Moon may give a "limb" of "lower" or "upper".
+    """
+
+    def __init__(self, *, backend="numpy", cache=None):
+        self.backend = backend
+        self.cache = cache
+        self.logger = logging.getLogger("FixServer")
+
+        self.logger.info("Warming up")
+        CelestialFix().load_catalogs()
+
+        self.prepared = queue.Queue(maxsize=16)
+        self.pending = queue.Queue(maxsize=16)
+        self.threads = [
+            threading.Thread(target=self.prepare_loop, daemon=True),
+            threading.Thread(target=self.solve_loop, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, line, reply):
+        """Queue one request line; reply is called with the response dict."""
+        self.prepared.put((line, reply))
+
+    def close(self):
+        """Wait for all submitted requests to be answered."""
+        self.prepared.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def prepare_loop(self):
+        while True:
+            job = self.prepared.get()
+            if job is None:
+                self.pending.put(None)
+                return
+
+            line, reply = job
+            request_id = None
+            try:
+                request = json.loads(line)
+                request_id = request.get("id")
+                cf = self.prepare(request)
+                self.pending.put((request_id, cf, None, reply))
+            except Exception as e:
+                self.pending.put((request_id, None, e, reply))
+
+    def solve_loop(self):
+        while True:
+            job = self.pending.get()
+            if job is None:
+                return
+
+            request_id, cf, error, reply = job
+            if error is None:
+                try:
+                    response = self.solve(cf)
+                except Exception as e:
+                    error = e
+
+            if error is not None:
+                self.logger.warning("Request %s failed: %s", request_id, error)
+                response = {"error": f"{error.__class__.__name__}: {error}"}
+
+            response["id"] = request_id
+            try:
+                reply(response)
+            except Exception as e:
+                # The client may be gone; keep serving the others.
+                self.logger.warning("Could not reply to %s: %s", request_id, e)
+
+    def prepare(self, request):
+        cf = CelestialFix(
+            ObservationParams(**request.get("observation_params", {})),
+            backend=request.get("backend", self.backend),
+            cache=self.cache,
+        )
+
+        sights = request["sights"]
+        if len(sights) == 0:
+            raise ValueError("No sights")
+
+        for sight in sights:
+            cf.add_observation(
+                sight["star"],
+                cf.ut1(*sight["time"], tz=sight.get("tz", 0)),
+                sight["alt"],
+                mag=sight.get("mag"),
+                limb=sight.get("limb"),
+            )
+            if "bearing" in sight or "speed_knots" in sight:
+                cf.set_bearing_speed(
+                    sight.get("bearing", cf.bearing.degrees),
+                    sight.get("speed_knots", cf.speed_knots),
+                )
+
+        cf.resolve_gps()
+        return cf
+
+    def solve(self, cf):
+        start = time_module.perf_counter()
+        lat, lon = cf.fix()
+        elapsed = time_module.perf_counter() - start
+
+        response = {
+            "fix": {
+                "lat": lat.degrees,
+                "lon": lon.degrees,
+                "text": format_coord((lat, lon)),
+            },
+            "solve_seconds": elapsed,
+            # A cached fix comes without the diagnostics of the local fix.
+            "cached": cf.local_fit is None,
+        }
+
+        if cf.local_fit is not None:
+            fit = cf.local_fit
+            response["observation_error"] = fit.observation_error.degrees
+            response["loss"] = fit.losses[-1]
+            response["dist_errors_nm"] = [
+                {"star": star, "nm": d} for star, d in fit.dist_errors
+            ]
+            response["positions"] = [
+                {"lat": p[0].degrees, "lon": p[1].degrees} for p in fit.positions
+            ]
+
+        return response
+
+    def serve_stream(self, infile, outfile):
+        """Answer the requests read from infile until it ends."""
+
+        def reply(response):
+            outfile.write(json.dumps(response) + "\n")
+            outfile.flush()
+
+        try:
+            for line in infile:
+                if line.strip():
+                    self.submit(line, reply)
+        finally:
+            self.close()
+
+    def serve_unix(self, path):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                lock = threading.Condition()
+                counts = {"submitted": 0, "answered": 0}
+
+                def reply(response):
+                    with lock:
+                        try:
+                            self.wfile.write(
+                                (json.dumps(response) + "\n").encode("utf-8")
+                            )
+                            self.wfile.flush()
+                        finally:
+                            counts["answered"] += 1
+                            lock.notify_all()
+
+                for line in self.rfile:
+                    if line.strip():
+                        with lock:
+                            counts["submitted"] += 1
+                        server.submit(line.decode("utf-8"), reply)
+
+                # Keep the connection open until every request has been answered.
+                with lock:
+                    lock.wait_for(lambda: counts["answered"] == counts["submitted"])
+
+        try:
+            # Only replace a socket left behind by an earlier run.
+            if os.path.lexists(path):
+                if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                    raise ValueError(f"Not a socket: {path}")
+                os.remove(path)
+
+            with socketserver.ThreadingUnixStreamServer(path, Handler) as unix_server:
+                self.logger.info("Listening on %s", path)
+                try:
+                    unix_server.serve_forever()
+                finally:
+                    os.remove(path)
+        finally:
+            self.close()
+
+
 def test_coord_vector():
     table = [
         ((0.0, 0.0), (1.0, 0.0, 0.0)),
@@ -516,6 +1929,389 @@ def test_coord_vector():
         assert np.allclose(vec_again, vec_ex)
 
 
+def synthetic_log():
+    log = []
+    for i in range(20):
+        log.append(
+            Observation(
+                star=f"Star {i}",
+                gp=(Angle(degrees=10.0 + i), Angle(degrees=-40.0 + 3.0 * i)),
+                alt=Angle(degrees=60.0 - i),
+            )
+        )
+        log.append(
+            RhumbLineMovement(
+                bearing=Angle(degrees=45.0), speed_knots=10.0, duration_hours=0.1
+            )
+        )
+    return log
+
+
+def autograd_saved_elements(loss_fn):
+    """Call loss_fn and count the tensor elements saved for the backward pass."""
+    import torch
+
+    sizes = []
+
+    def pack(tensor):
+        sizes.append(tensor.numel())
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = loss_fn()
+    loss.backward()
+    return sum(sizes)
+
+
+def test_navigation_model_chunked():
+    import pytest
+
+    pytest.importorskip("torch")
+    NavigationModel = torch_navigation_model()
+
+    log = synthetic_log()
+    pos = (Angle(degrees=30.0), Angle(degrees=-30.0))
+
+    results = []
+    for chunk_size in [None, 1, 7, 100]:
+        model = NavigationModel(pos, log, chunk_size=chunk_size)
+        loss = model()
+        loss.backward()
+        grads = [p.grad.item() for p in model.parameters()]
+        positions, dist_errors = model.report()
+        results.append((positions, dist_errors, loss.item(), grads))
+
+    positions_ex, dist_errors_ex, loss_ex, grads_ex = results[0]
+    for positions, dist_errors, loss, grads in results[1:]:
+        assert [format_coord(p) for p in positions] == [
+            format_coord(p) for p in positions_ex
+        ]
+        assert [star for star, _ in dist_errors] == [star for star, _ in dist_errors_ex]
+        assert np.allclose(
+            [d for _, d in dist_errors], [d for _, d in dist_errors_ex], atol=1e-3
+        )
+        assert np.isclose(loss, loss_ex, rtol=1e-5)
+        assert np.allclose(grads, grads_ex, rtol=1e-4)
+
+    # Only the segment boundaries stay in the graph, so it grows with the number of
+    # segments, not with the length of the log.
+    saved_short = autograd_saved_elements(NavigationModel(pos, log, chunk_size=40))
+    saved_long = autograd_saved_elements(NavigationModel(pos, log * 10, chunk_size=40))
+    assert saved_long == 10 * saved_short
+    assert saved_long < autograd_saved_elements(NavigationModel(pos, log)) / 10
+
+
+def test_numpy_navigation_model_grad():
+    model = NumpyNavigationModel(
+        (Angle(degrees=30.0), Angle(degrees=-30.0)), synthetic_log()
+    )
+    model.params[2] = 0.1
+    loss, grad = model.loss_and_grad()
+
+    params = model.params.copy()
+    for i, h in enumerate([1e-7, 1e-7, 1e-5]):
+        model.params[:] = params
+        model.params[i] += h
+        loss_plus, _ = model.loss_and_grad()
+        model.params[i] -= 2.0 * h
+        loss_minus, _ = model.loss_and_grad()
+        assert np.isclose(grad[i], (loss_plus - loss_minus) / (2.0 * h), rtol=1e-4)
+
+
+def test_numpy_navigation_model_matches_torch():
+    import pytest
+
+    pytest.importorskip("torch")
+    NavigationModel = torch_navigation_model()
+
+    log = synthetic_log()
+    pos = (Angle(degrees=30.0), Angle(degrees=-30.0))
+
+    torch_model = NavigationModel(pos, log)
+    loss_ex = torch_model()
+    loss_ex.backward()
+    positions_ex, dist_errors_ex = torch_model.report()
+
+    numpy_model = NumpyNavigationModel(pos, log)
+    loss, grad = numpy_model.loss_and_grad()
+    positions, dist_errors = numpy_model.report()
+
+    assert [format_coord(p) for p in positions] == [
+        format_coord(p) for p in positions_ex
+    ]
+    assert np.allclose(
+        [d for _, d in dist_errors], [d for _, d in dist_errors_ex], atol=1e-2
+    )
+    assert np.isclose(loss, loss_ex.item(), rtol=1e-4)
+    assert np.allclose(
+        grad, [p.grad.item() for p in torch_model.parameters()], rtol=1e-3
+    )
+
+
+def test_import_without_torch():
+    # The numpy backend must not pull in torch.
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, mctoon_global_navigation_challenge as m; "
+            + "m.CelestialFix(); "
+            + "assert 'torch' not in sys.modules",
+        ],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True,
+    )
+
+
+def test_fix_cache(tmp_path):
+    def sights(alt):
+        cf = CelestialFix(cache=FixCache(tmp_path, max_bytes=150))
+        cf.set_bearing_speed(90.0, 5.0)
+        cf.add_observation("Vega", cf.ut1(2022, 4, 9, 0, 28, 0), dms(alt))
+        cf.add_observation("Deneb", cf.ut1(2022, 4, 9, 0, 30, 0), dms(40))
+        return cf
+
+    assert sights(50).cache_key() == sights(50).cache_key()
+    assert sights(50).cache_key() != sights(51).cache_key()
+
+    cf = sights(50)
+    cf.chunk_size = 1
+    assert cf.cache_key() == sights(50).cache_key()
+
+    positions = {}
+    for alt in range(50, 55):
+        cf = sights(alt)
+        positions[alt] = (Angle(degrees=alt), Angle(degrees=-alt))
+        cf.cache.put(cf.cache_key(), positions[alt])
+
+    # Served from the directory without touching the ephemeris or the solver.
+    for alt in [53, 54]:
+        assert format_coord(sights(alt).fix()) == format_coord(positions[alt])
+
+    # Older entries were evicted to stay within max_bytes.
+    assert len(list(tmp_path.glob("*.json"))) < 5
+    assert sights(50).cache.get(sights(50).cache_key()) is None
+
+
+def test_fix_cache_shared_directory(tmp_path):
+    # Several caches putting to and evicting from the same directory at once.
+    errors = []
+
+    def put_fixes(i):
+        cache = FixCache(tmp_path, max_entries=0, max_bytes=1000)
+        try:
+            for j in range(300):
+                cache.put(f"{i}-{j}", (Angle(degrees=i), Angle(degrees=j / 10.0)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=put_fixes, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sum(path.stat().st_size for path in tmp_path.glob("*.json")) <= 4 * 1000
+
+    # A failed write leaves no temporary file behind.
+    import pytest
+
+    with pytest.raises(TypeError):
+        FixCache(tmp_path).put(
+            "bad", (Angle(radians=np.float32(1.0)), Angle(radians=0.0))
+        )
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+def test_fix_global_grid():
+    # Two sights whose circles of equal altitude intersect at pos_ex and a second
+    # point.
+    pos_ex = (Angle(degrees=40.0), Angle(degrees=-30.0))
+
+    def sights(bearing_error_deg=None):
+        cf = CelestialFix()
+        for star, gp_d in [("A", (10.0, -20.0)), ("B", (50.0, 10.0))]:
+            gp = (Angle(degrees=gp_d[0]), Angle(degrees=gp_d[1]))
+            pos_r = (pos_ex[0].radians, pos_ex[1].radians)
+            gp_r = (gp[0].radians, gp[1].radians)
+            dist_nm = NumpyNavigationModel.distance_to_gp_nm(pos_r, gp_r)
+            alt = Angle(degrees=90.0 - dist_nm / 60.0)
+            mag = None
+            if bearing_error_deg is not None:
+                angle = NumpyNavigationModel.angle_to_gp(pos_r, gp_r)
+                mag = Angle(degrees=np.rad2deg(angle) + bearing_error_deg)
+            cf.log.append(Observation(star=star, alt=alt, gp=gp, mag=mag))
+        return cf
+
+    cf = sights()
+    solutions = cf.fix_global_grid()
+    assert len(solutions) >= 2
+    assert solutions[0][1] < 1e-4 and solutions[1][1] < 1e-4
+    assert format_coord(pos_ex) in [format_coord(pos) for pos, _ in solutions[:2]]
+
+    # Without bearings, the first of the equally good solutions.
+    assert format_coord(cf.fix_global_rough()) == format_coord(solutions[0][0])
+
+    # Even rough bearings pick the right one.
+    for bearing_error_deg in [-10.0, 0.0, 10.0]:
+        pos = sights(bearing_error_deg).fix_global_rough()
+        assert format_coord(pos) == format_coord(pos_ex)
+
+
+def test_fix_global_rough_ill_conditioned():
+    import pytest
+
+    # GPs within 0.05° of one great circle. With errors of 0.5′ in the altitudes, the
+    # plane intersection is some 15° off.
+    pos_ex = (Angle(degrees=40.0), Angle(degrees=-30.0))
+    pos_r = (pos_ex[0].radians, pos_ex[1].radians)
+
+    cf = CelestialFix()
+    for star, gp_d, error_min in [
+        ("A", (0.0, -70.0), 0.5),
+        ("B", (0.05, -30.0), -0.5),
+        ("C", (0.0, 10.0), 0.5),
+    ]:
+        gp = (Angle(degrees=gp_d[0]), Angle(degrees=gp_d[1]))
+        dist_nm = NumpyNavigationModel.distance_to_gp_nm(
+            pos_r, (gp[0].radians, gp[1].radians)
+        )
+        alt = Angle(degrees=90.0 - (dist_nm - error_min) / 60.0)
+        cf.log.append(Observation(star=star, alt=alt, gp=gp))
+
+    for pos in [cf.fix_global_rough(), cf.fix()]:
+        assert (
+            NumpyNavigationModel.distance_to_gp_nm(
+                pos_r, (pos[0].radians, pos[1].radians)
+            )
+            < 1.0
+        )
+
+    # No fix from fewer than two observations.
+    for log in [[], cf.log[:1]]:
+        cf.log = log
+        with pytest.raises(ValueError):
+            cf.fix()
+        with pytest.raises(ValueError):
+            cf.fix_global_grid()
+
+
+def test_fix_server():
+    import io
+
+    requests = [
+        # test_fix_3
+        {
+            "id": "a",
+            "sights": [
+                {"star": star, "time": [2021, 12, 17, 10, 35, 27], "alt": alt}
+                for star, alt in [
+                    ("Alkaid", dms(56, 7, 3.3)),
+                    ("Capella", dms(33, 42, 42.5)),
+                    ("Alphard", dms(38, 5, 46.3)),
+                ]
+            ],
+        },
+        {"id": "b", "sights": [{"star": "Nonexistent", "time": [2021, 1, 1]}]},
+        # test_fix_1
+        {
+            "id": "c",
+            "observation_params": {
+                "index_error_min": 0.3,
+                "eye_height_m": 2,
+                "temperature_degC": 12,
+                "pressure_hPa": 975,
+            },
+            "sights": [
+                {
+                    "star": "Regulus",
+                    "time": [2018, 11, 15, 8, 28, 15],
+                    "alt": dms(70, 48.7),
+                    "bearing": 0.0,
+                    "speed_knots": 12.0,
+                },
+                {
+                    "star": "Arcturus",
+                    "time": [2018, 11, 15, 8, 30, 30],
+                    "alt": dms(27, 9.0),
+                },
+                {
+                    "star": "Dubhe",
+                    "time": [2018, 11, 15, 8, 32, 15],
+                    "alt": dms(55, 18.4),
+                },
+            ],
+        },
+    ]
+
+    out = io.StringIO()
+    FixServer().serve_stream(
+        io.StringIO("".join(json.dumps(r) + "\n" for r in requests) + "{\n"), out
+    )
+    responses = [json.loads(line) for line in out.getvalue().splitlines()]
+
+    assert [r["id"] for r in responses] == ["a", "b", "c", None]
+    assert responses[0]["fix"]["text"] == " 40°28.8′N  85°05.7′W"
+    assert [d["star"] for d in responses[0]["dist_errors_nm"]] == [
+        "Alkaid",
+        "Capella",
+        "Alphard",
+    ]
+    assert "error" in responses[1] and "error" in responses[3]
+    assert responses[2]["fix"]["text"] == " 29°41.0′N  36°57.3′W"
+    assert len(responses[2]["positions"]) == 3
+
+
+def test_fix_server_cache(tmp_path):
+    import io
+
+    request = {
+        "sights": [
+            {"star": star, "time": [2021, 12, 17, 10, 35, 27], "alt": alt}
+            for star, alt in [
+                ("Alkaid", dms(56, 7, 3.3)),
+                ("Capella", dms(33, 42, 42.5)),
+                ("Alphard", dms(38, 5, 46.3)),
+            ]
+        ],
+    }
+
+    out = io.StringIO()
+    FixServer(cache=FixCache()).serve_stream(
+        io.StringIO((json.dumps(request) + "\n") * 2), out
+    )
+    first, second = [json.loads(line) for line in out.getvalue().splitlines()]
+
+    assert first["fix"] == second["fix"]
+    assert not first["cached"] and "positions" in first
+    assert second["cached"] and "positions" not in second
+
+    # A reply which fails doesn't stop the server.
+    def broken_reply(response):
+        raise ValueError("I/O operation on closed file.")
+
+    responses = []
+    server = FixServer()
+    server.submit("{}", broken_reply)
+    server.submit("{}", responses.append)
+    server.close()
+    assert len(responses) == 1 and "error" in responses[0]
+
+    # Refuse to replace anything but a stale socket.
+    path = tmp_path / "not-a-socket"
+    path.write_text("keep me")
+    server = FixServer()
+    try:
+        server.serve_unix(str(path))
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert path.read_text() == "keep me"
+    assert not any(thread.is_alive() for thread in server.threads)
+
+
 def test_ut1_tz():
     cf = CelestialFix()
     assert cf.ut1(1982, 7, 18, 22, 37, 30, tz=-7) == cf.ut1(1982, 7, 19, 5, 37, 30)
@@ -640,6 +2436,160 @@ def test_star_gp():
         assert abs((lon_ex.degrees - lon.degrees) * 600.0) < 1
 
 
+def test_star_gps():
+    cf = CelestialFix()
+    names = ["Dubhe", "Rigel", "Aldebaran", "Polaris"]
+    times = cf.ts.linspace(
+        cf.ut1(2020, 10, 15, 5, 0, 0), cf.ut1(2020, 10, 15, 8, 0, 0), 7
+    )
+
+    lats, lons = cf.star_gps(names, times)
+    assert lats.shape == lons.shape == (len(names), len(times))
+
+    for i, name in enumerate(names):
+        for j in range(len(times)):
+            lat_ex, lon_ex = cf.star_gp(name, times[j])
+            lon = norm_angle(Angle(radians=lons[i, j]))
+            assert abs((lat_ex.degrees - np.rad2deg(lats[i, j])) * 600.0) < 1
+            assert abs((lon_ex.degrees - lon.degrees) * 600.0) < 1
+
+
+def test_body_gps():
+    cf = CelestialFix()
+    times = cf.ts.linspace(cf.ut1(2022, 5, 23, 0), cf.ut1(2022, 5, 24, 0), 5)
+
+    for body in ["Sun", "Moon", "Venus", "Jupiter"]:
+        lats, lons, sds, hps = cf.body_gps(body, times)
+        assert lats.shape == lons.shape == sds.shape == hps.shape == (len(times),)
+
+        # The same as one at a time.
+        for i, time in enumerate(times):
+            lat, lon, sd, hp = cf.body_gps(
+                body, cf.ts.tt_jd([time.whole], [time.tt_fraction])
+            )
+            assert np.allclose(
+                np.ravel((lat, lon, sd, hp)), (lats[i], lons[i], sds[i], hps[i])
+            )
+
+    # Semidiameters and horizontal parallaxes from the almanac, roughly.
+    _, _, sds, hps = cf.body_gps("Sun", times)
+    assert np.all(np.abs(np.rad2deg(sds) * 60.0 - 15.8) < 0.2)
+    assert np.all(np.abs(np.rad2deg(hps) * 60.0 - 0.1) < 0.1)
+    _, _, sds, hps = cf.body_gps("Moon", times)
+    assert np.all((np.rad2deg(sds) * 60.0 > 14.5) & (np.rad2deg(sds) * 60.0 < 16.8))
+    assert np.all((np.rad2deg(hps) * 60.0 > 53.9) & (np.rad2deg(hps) * 60.0 < 61.5))
+
+
+def test_navigational_stars():
+    # The selected stars of the Nautical Almanac and Polaris, with Eltanin, Al Na'ir
+    # and Rigil Kent. as named in named_star_dict.
+    almanac = [
+        "Acamar",
+        "Achernar",
+        "Acrux",
+        "Adhara",
+        "Aldebaran",
+        "Alioth",
+        "Alkaid",
+        "Alnair",
+        "Alnilam",
+        "Alphard",
+        "Alphecca",
+        "Alpheratz",
+        "Altair",
+        "Ankaa",
+        "Antares",
+        "Arcturus",
+        "Atria",
+        "Avior",
+        "Bellatrix",
+        "Betelgeuse",
+        "Canopus",
+        "Capella",
+        "Deneb",
+        "Denebola",
+        "Diphda",
+        "Dubhe",
+        "Elnath",
+        "Etamin",
+        "Enif",
+        "Fomalhaut",
+        "Gacrux",
+        "Gienah",
+        "Hadar",
+        "Hamal",
+        "Kaus Australis",
+        "Kochab",
+        "Markab",
+        "Menkar",
+        "Menkent",
+        "Miaplacidus",
+        "Mirfak",
+        "Nunki",
+        "Peacock",
+        "Polaris",
+        "Pollux",
+        "Procyon",
+        "Rasalhague",
+        "Regulus",
+        "Rigel",
+        "Rigil Kentaurus",
+        "Sabik",
+        "Schedar",
+        "Shaula",
+        "Sirius",
+        "Spica",
+        "Suhail",
+        "Vega",
+        "Zubenelgenubi",
+    ]
+    missing = {"Acamar", "Menkar", "Zubenelgenubi"}
+
+    assert len(almanac) == 58
+    assert sorted(NAVIGATIONAL_STARS) == sorted(set(almanac) - missing)
+    for name in missing:
+        assert name not in named_star_dict
+
+    assert star_hip("Gienah") == 59803
+    assert star_hip("Markab") == 113963
+    assert star_hip("Arcturus") == named_star_dict["Arcturus"]
+
+
+def test_plan_sights():
+    # The twilight of test_fix_2.
+    cf = CelestialFix()
+    plans = cf.plan_sights(
+        (Angle(degrees=30.0), Angle(degrees=-14.0)),
+        cf.ut1(2020, 10, 15, 6, 20, 0),
+        cf.ut1(2020, 10, 15, 6, 50, 0),
+        min_azimuth_spread_deg=40.0,
+    )
+
+    assert len(plans) == 5
+    assert [p.score for p in plans] == sorted([p.score for p in plans], reverse=True)
+    assert len({p.stars for p in plans}) == len(plans)
+
+    for plan in plans:
+        assert 0.0 < plan.score <= 1.0
+        for alt in plan.alts:
+            assert 15.0 <= alt.degrees <= 75.0
+        azimuths = [az.degrees for az in plan.azimuths]
+        for a, b in itertools.combinations(azimuths, 2):
+            assert abs(np.mod(a - b + 180.0, 360.0) - 180.0) >= 40.0
+
+        # The plan should agree with a star at a time.
+        pos = (Angle(degrees=30.0), Angle(degrees=-14.0))
+        gp = cf.star_gp(plan.stars[0], plan.time)
+        alt = (
+            90.0
+            - NumpyNavigationModel.distance_to_gp_nm(
+                (pos[0].radians, pos[1].radians), (gp[0].radians, gp[1].radians)
+            )
+            / 60.0
+        )
+        assert abs(alt - plan.alts[0].degrees) < 0.1
+
+
 def test_fix_1():
     # https://mctoon.net/10000-flat-earth-sextant-challenge/
     #
@@ -684,8 +2634,8 @@ def test_fix_2():
     cf.add_observation("Rigel", cf.ut1(2020, 10, 15, 6, 37, 9), dms(42, 7))
     cf.add_observation("Aldebaran", cf.ut1(2020, 10, 15, 6, 41, 11), dms(50, 25))
     cf.add_observation("Polaris", cf.ut1(2020, 10, 15, 6, 43, 0), dms(30, 18))
-    # TODO: Venus
-    assert format_coord(cf.fix()) == " 29°55.7′N  14°20.4′W"
+    cf.add_observation("Venus", cf.ut1(2020, 10, 15, 6, 45, 5), dms(33, 43))
+    assert format_coord(cf.fix()) == " 29°55.5′N  14°20.0′W"
 
 
 def test_fix_3():
@@ -802,5 +2752,45 @@ def test_fix_7():
     assert format_coord(cf.fix()) == " 23°34.1′S  46°37.8′W"
 
 
+def test_fix_8():
+    # Simulated with Skyfield for an observer at 35°N 40°W, with Skyfield's own
+    # refraction for 10°C and 1010 hPa.
+
+    # Official position: 35°00.0′N 40°00.0′W
+
+    cf = CelestialFix()
+    cf.add_observation(
+        "Sun", cf.ut1(2022, 5, 23, 12, 0, 0), dms(52, 31.3), limb="lower"
+    )
+    cf.add_observation(
+        "Moon", cf.ut1(2022, 5, 23, 12, 2, 0), dms(31, 5.0), limb="upper"
+    )
+    cf.add_observation("Venus", cf.ut1(2022, 5, 23, 12, 4, 0), dms(62, 29.3))
+    assert format_coord(cf.fix()) == " 35°00.0′N  40°00.1′W"
+
+    # The semidiameter would be corrected twice.
+    cf = CelestialFix(ObservationParams(semidiameter_correction_min=15.8))
+    try:
+        cf.add_observation(
+            "Sun", cf.ut1(2022, 5, 23, 12, 0, 0), dms(52, 15.5), limb="lower"
+        )
+    except ValueError:
+        pass
+    else:
+        assert False
+
+    # Planets and stars are observed by their centers.
+    cf = CelestialFix()
+    for star in ["Venus", "Jupiter", "Vega"]:
+        try:
+            cf.add_observation(
+                star, cf.ut1(2022, 5, 23, 12, 4, 0), dms(62, 29.3), limb="lower"
+            )
+        except ValueError:
+            pass
+        else:
+            assert False
+
+
 if __name__ == "__main__":
     main()